@@ -1,13 +1,72 @@
+import base64
 import calendar
+import contextlib
+import datetime
+import hashlib
+import numbers
 import os
 import json
+import re
+import tempfile
+import time
 
+import numpy as np
 import pandas as pd
 import click
 import requests
 
-from typing import Dict, Any, List, Union
-from dotenv import load_dotenv, dotenv_values
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, FrozenSet, List, Optional, Tuple, Union
+from dotenv import dotenv_values
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+YES_NO_DICT: Dict[str, str] = {"yes": "Y", "no": "N"}
+
+# Value types openpyxl can write to a cell as-is
+EXCEL_CELL_TYPES = (str, numbers.Number, datetime.date, datetime.time)
+
+CACHE_DIR: str = os.path.join(
+    os.path.expanduser("~"), ".cache", "metadata-for-user-facility-transformations"
+)
+
+
+@lru_cache(maxsize=1)
+def _load_env(env_path: str) -> Dict[str, Optional[str]]:
+    """
+    Reads the variables from a .env file, only touching the disk once per path.
+
+    :param env_path: Path to the .env file.
+    :return: The variables defined in the .env file.
+    """
+    return dotenv_values(env_path)
+
+
+def _write_cache_file(cache_path: str, data: Any) -> None:
+    """
+    Writes JSON data to a file in CACHE_DIR, readable only by the current user.
+    The data goes to a temporary file that is then moved into place, so an
+    interrupted run never leaves a partial file behind. A cache that can't be
+    written is skipped rather than failing the run.
+
+    :param cache_path: Path to the cache file.
+    :param data: The JSON-serializable data to write.
+    """
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+    except OSError:
+        pass
 
 
 class MetadataRetriever:
@@ -21,59 +80,161 @@ class MetadataRetriever:
         "jgi_mt": "jgi_mt_data",
     }
 
-    def __init__(self, metadata_submission_id: str, user_facility: str) -> None:
+    USER_FACILITY_KEYS: FrozenSet[str] = frozenset(USER_FACILITY_DICT.values())
+
+    DNASE_COLUMN_DICT: Dict[str, str] = {
+        "jgi_mg": "dna_dnase",
+        "jgi_mt": "dnase_rna",
+    }
+
+    # Seconds a cached submission record is reused before fetching it again
+    SUBMISSION_CACHE_TTL: int = 600
+
+    # Seconds before its expiry at which a cached access token is refreshed
+    ACCESS_TOKEN_EXPIRY_MARGIN: int = 60
+
+    def __init__(
+        self, metadata_submission_id: str, user_facility: str, use_cache: bool = True
+    ) -> None:
         """
         Initialize the MetadataRetriever.
 
         :param metadata_submission_id: The ID of the metadata submission.
         :param user_facility: The user facility to retrieve data from.
+        :param use_cache: True to reuse a recently fetched submission record.
         """
         self.metadata_submission_id = metadata_submission_id
         self.user_facility = user_facility
+        self.use_cache = use_cache
         self.load_and_set_env_vars()
         self.base_url = self.env.get("SUBMISSION_PORTAL_BASE_URL")
+        # Reuse one connection pool for the auth refresh and submission requests
+        self.session = requests.Session()
 
     def load_and_set_env_vars(self):
         """Loads and sets environment variables from .env file."""
         env_path = os.path.join(os.path.dirname(__file__), ".env")
-        env_vars = dotenv_values(env_path)
+        env_vars = _load_env(env_path)
         for key, value in env_vars.items():
             os.environ[key] = value
 
         self.env: Dict[str, str] = dict(os.environ)
 
-    def retrieve_metadata_records(self, unique_field: str) -> pd.DataFrame:
+    def get_access_token(self, force_refresh: bool = False) -> Tuple[str, bool]:
         """
-        Retrieves the metadata records for the given submission ID and user facility.
+        Gets an access token for the Submission Portal API, reusing the token
+        cached on disk by a previous run until it is about to expire.
 
-        :return: The retrieved metadata records as a Pandas DataFrame.
+        :param force_refresh: True to always exchange the refresh token.
+        :return: The access token, and True if it was served from the cache.
         """
-        self.load_and_set_env_vars()
-
-        refresh_response = requests.post(
+        token_path = os.path.join(CACHE_DIR, "access_token.json")
+        refresh_token = self.env["DATA_PORTAL_REFRESH_TOKEN"]
+        # Only reuse a token issued for the same portal and refresh token
+        token_key = hashlib.sha256(
+            f"{self.base_url}\n{refresh_token}".encode()
+        ).hexdigest()
+
+        if not force_refresh and os.path.exists(token_path):
+            try:
+                with open(token_path, "r") as f:
+                    cached_token: Dict[str, Any] = json.load(f)
+                if (
+                    cached_token["key"] == token_key
+                    and cached_token["exp"] - time.time()
+                    > self.ACCESS_TOKEN_EXPIRY_MARGIN
+                ):
+                    return cached_token["access_token"], True
+            except (OSError, ValueError, KeyError, TypeError):
+                pass  # unreadable cache, fall through to a refresh
+
+        refresh_response = self.session.post(
             f"{self.base_url}/auth/refresh",
-            json={"refresh_token": self.env["DATA_PORTAL_REFRESH_TOKEN"]},
+            json={"refresh_token": refresh_token},
         )
         refresh_response.raise_for_status()
         refresh_body = refresh_response.json()
         access_token = refresh_body["access_token"]
 
+        # Read the expiry time from the JWT payload; tokens without one aren't cached
+        try:
+            payload = access_token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            exp = json.loads(base64.urlsafe_b64decode(payload))["exp"]
+        except (IndexError, ValueError, KeyError, TypeError):
+            return access_token, False
+
+        _write_cache_file(
+            token_path, {"key": token_key, "exp": exp, "access_token": access_token}
+        )
+
+        return access_token, False
+
+    def get_submission_record(self) -> Dict[str, Any]:
+        """
+        Gets the submission record from the Submission Portal API, reusing the
+        copy cached on disk by a previous run if it is recent enough.
+
+        :return: The metadata submission record.
+        """
+        # Name the cache file by a hash of the portal and submission id, so records
+        # from different portals (e.g. dev and prod) are cached separately and a
+        # submission id can't point the path outside CACHE_DIR
+        cache_key = hashlib.sha256(
+            f"{self.base_url}\n{self.metadata_submission_id}".encode()
+        ).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, f"submission-{cache_key}.json")
+        use_cache = self.use_cache and os.path.dirname(
+            os.path.realpath(cache_path)
+        ) == os.path.realpath(CACHE_DIR)
+        if use_cache:
+            try:
+                if (
+                    time.time() - os.path.getmtime(cache_path)
+                    < self.SUBMISSION_CACHE_TTL
+                ):
+                    with open(cache_path, "r") as f:
+                        return json.load(f)
+            except (OSError, ValueError):
+                pass  # missing or unreadable cache, fetch the record again
+
+        url = f"{self.base_url}/api/metadata_submission/{self.metadata_submission_id}"
+        access_token, from_cache = self.get_access_token()
         headers = {
             "content-type": "application/json; charset=UTF-8",
             "Authorization": f"Bearer {access_token}",
         }
-        response: Dict[str, Any] = requests.get(
-            f"{self.base_url}/api/metadata_submission/{self.metadata_submission_id}",
-            headers=headers,
-        ).json()
+        submission_response = self.session.get(url, headers=headers)
+        if submission_response.status_code == 401 and from_cache:
+            # The cached access token was rejected, so refresh it and try once more
+            access_token, _ = self.get_access_token(force_refresh=True)
+            headers["Authorization"] = f"Bearer {access_token}"
+            submission_response = self.session.get(url, headers=headers)
+        submission_response.raise_for_status()
+        response: Dict[str, Any] = submission_response.json()
+
+        if use_cache:
+            _write_cache_file(cache_path, response)
+
+        return response
+
+    def retrieve_metadata_records(self, unique_field: str) -> pd.DataFrame:
+        """
+        Retrieves the metadata records for the given submission ID and user facility.
+
+        :return: The retrieved metadata records as a Pandas DataFrame.
+        """
+        response = self.get_submission_record()
+        all_sample_data: Dict[str, Any] = response["metadata_submission"]["sampleData"]
 
         # Get user-facility key data
         common_df: pd.DataFrame = pd.DataFrame()
         if self.user_facility in self.USER_FACILITY_DICT:
-            user_facility_data: Dict[str, Any] = response["metadata_submission"][
-                "sampleData"
-            ].get(self.USER_FACILITY_DICT[self.user_facility], {})
-            common_df = pd.DataFrame(user_facility_data)
+            user_facility_data: Dict[str, Any] = all_sample_data.get(
+                self.USER_FACILITY_DICT[self.user_facility], {}
+            )
+            # Submission Portal values are kept as-is, skipping dtype inference
+            common_df = pd.DataFrame(user_facility_data, dtype=object)
 
         # Check if common_df is empty
         if common_df.empty:
@@ -84,69 +245,133 @@ class MetadataRetriever:
             df = common_df
 
         # Find non-user-facility keys (ie, plant_associated, water, etc)
-        all_keys_data = response["metadata_submission"]["sampleData"]
-        user_facility_keys = ["emsl_data", "jgi_mg_data", "jgi_mt_data"]
         sample_data_keys = [
-            key for key in all_keys_data if key not in user_facility_keys
+            key for key in all_sample_data if key not in self.USER_FACILITY_KEYS
         ]
 
-        # Loop through resulting keys and combine with common_df by samp_name
+        # Collect the non-empty sample data for each key, tagging every row with
+        # the key name for the 'Sample Isolated From' col in jgi mg/mt
+        sample_data_frames: List[pd.DataFrame] = []
         for key in sample_data_keys:
 
-            sample_data: Dict[str, Any] = response["metadata_submission"][
-                "sampleData"
-            ].get(key, {})
-            sample_data_df = pd.DataFrame(sample_data)
+            sample_data: Dict[str, Any] = all_sample_data.get(key)
+            if not sample_data:
+                continue
+            sample_data_df = pd.DataFrame(sample_data, dtype=object)
 
             if not sample_data_df.empty:
-                df = pd.merge(df, sample_data_df, on="samp_name", how="left")
+                sample_data_frames.append(
+                    sample_data_df.assign(sample_isolated_from=key)
+                )
 
-            # Append the non-UF key name into the df for 'Sample Isolated From' col in jgi mg/mt
-            df['sample_isolated_from'] = key
+        # Combine all sample data with common_df by samp_name in a single merge
+        if sample_data_frames:
+            combined_df = pd.concat(sample_data_frames, ignore_index=True, copy=False)
+            # Only a handful of package names repeat across every row
+            combined_df["sample_isolated_from"] = pd.Categorical(
+                combined_df["sample_isolated_from"], categories=sample_data_keys
+            )
+            try:
+                df = df.merge(
+                    combined_df, on="samp_name", how="left", validate="m:1", copy=False
+                )
+            except pd.errors.MergeError:
+                # Work out which packages each repeated samp_name comes from
+                duplicated = combined_df.loc[
+                    combined_df["samp_name"].duplicated(keep=False),
+                    ["samp_name", "sample_isolated_from"],
+                ]
+                missing_packages: List[str] = []
+                packages_by_name: Dict[str, List[str]] = {}
+                for name, package in duplicated.itertuples(index=False, name=None):
+                    packages = (
+                        missing_packages
+                        if pd.isna(name)
+                        else packages_by_name.setdefault(name, [])
+                    )
+                    if package not in packages:
+                        packages.append(package)
+
+                problems: List[str] = [
+                    f"{name} duplicated within {packages[0]}"
+                    if len(packages) == 1
+                    else f"{name} shared by {', '.join(packages)}"
+                    for name, packages in packages_by_name.items()
+                ]
+                if missing_packages:
+                    problems.append(
+                        f"missing samp_name repeated in {', '.join(missing_packages)}"
+                    )
+                raise ValueError(
+                    f"samp_name values are not unique in submission metadata record {self.metadata_submission_id}: {'; '.join(problems)}"
+                ) from None
 
         # Begin collecting detailed sample data
+        # Derived columns are gathered here and added to df in a single assign
+        new_cols: Dict[str, Any] = {}
 
         if "lat_lon" in df.columns:
-            df[["latitude", "longitude"]] = df["lat_lon"].str.split(" ", expand=True)
+            new_cols["latitude"], new_cols["longitude"] = zip(
+                *(
+                    (s.split(" ", 1) + [None])[:2]
+                    if isinstance(s, str)
+                    else (None, None)
+                    for s in df["lat_lon"].to_numpy()
+                )
+            )
 
         if "depth" in df.columns:
-            # Case - different delimiters used
-            df["depth"] = df["depth"].str.replace("-", " - ")
+            # Case - different delimiters used ("0-5", "0 - 5", "0 -5")
+            depth_parts = [
+                re.split(r"\s*-\s*", s, maxsplit=1) if isinstance(s, str) else None
+                for s in df["depth"].to_numpy()
+            ]
+            new_cols["depth"] = [
+                " - ".join(p) if p is not None else None for p in depth_parts
+            ]
             # Case - only one value provided for depth (single value will be max and min)
-            dfNew = df["depth"].str.split(" - ", expand=True)
-            if dfNew.shape[0] == 1:
-                df[["minimum_depth"]] = dfNew[0]
-                df[["maximum_depth"]] = dfNew[0]
-            else:
-                df[["minimum_depth", "maximum_depth"]] = df["depth"].str.split(
-                    " - ", expand=True
-                )
+            new_cols["minimum_depth"], new_cols["maximum_depth"] = zip(
+                *((p[0], p[-1]) if p is not None else (None, None) for p in depth_parts)
+            )
 
         if "geo_loc_name" in df.columns:
-            df["country_name"] = df["geo_loc_name"].str.split(":").str[0]
+            new_cols["country_name"] = [
+                s.split(":", 1)[0] if isinstance(s, str) else s
+                for s in df["geo_loc_name"].to_numpy()
+            ]
 
         if "collection_date" in df.columns:
-            df["collection_year"] = df["collection_date"].str.split("-").str[0]
-            df["collection_month"] = df["collection_date"].str.split("-").str[1]
-            df["collection_day"] = df["collection_date"].str.split("-").str[2]
+            (
+                new_cols["collection_year"],
+                new_cols["collection_month"],
+                new_cols["collection_day"],
+            ) = zip(
+                *(
+                    (s.split("-", 2) + [None] * 3)[:3]
+                    if isinstance(s, str)
+                    else (None,) * 3
+                    for s in df["collection_date"].to_numpy()
+                )
+            )
 
-            # Safely map collection_month to month_name (account for NaN values)
-            def get_month_name(month):
-                try:
-                    return calendar.month_name[int(month)]
-                except (ValueError, TypeError):
-                    return "" # return empty string for invalid cases
+            # Map collection_month to month_name with a lookup on the month number;
+            # missing or invalid months fall back to index 0, an empty string
+            month_names = np.array(calendar.month_name, dtype=object)
+            month_numbers = pd.to_numeric(
+                pd.Series(new_cols["collection_month"], dtype=object), errors="coerce"
+            )
+            month_numbers = month_numbers.where(month_numbers.between(1, 12), 0)
+            new_cols["collection_month_name"] = np.take(
+                month_names, month_numbers.to_numpy(dtype=np.int8)
+            )
 
-            df["collection_month_name"] = df["collection_month"].apply(get_month_name)
+        df = df.assign(**new_cols)
 
         # Address 'Was sample DNAse treated?' col
         # Change from 'yes/no' to 'Y/N'
-        if self.user_facility == 'jgi_mg':
-            df.loc[df["dna_dnase"] == "yes", "dna_dnase"] = 'Y'
-            df.loc[df["dna_dnase"] == "no", "dna_dnase"] = 'N'
-        if self.user_facility == 'jgi_mt':
-            df.loc[df["dnase_rna"] == "yes", "dnase_rna"] = 'Y'
-            df.loc[df["dnase_rna"] == "no", "dnase_rna"] = 'N'
+        dnase_col = self.DNASE_COLUMN_DICT.get(self.user_facility)
+        if dnase_col is not None:
+            df[dnase_col] = df[dnase_col].map(YES_NO_DICT).fillna(df[dnase_col])
 
         return df
 
@@ -184,20 +409,16 @@ class SpreadsheetCreator:
             ]
             d[k] = l
 
-        headers_df: pd.DataFrame = pd.DataFrame(d)
-
-        if header:
-            last_row = headers_df.iloc[-1]
-            column_values: List[str] = list(last_row)
+        if not header:
+            return pd.DataFrame(d)
 
-            headers_df = headers_df.drop(headers_df.index[-1])
-            headers_df.loc[len(headers_df)] = headers_df.columns.to_list()
-            headers_df.columns = column_values
-
-            shift = 1
-            headers_df = pd.concat(
-                [headers_df.iloc[-shift:], headers_df.iloc[:-shift]], ignore_index=True
-            )
+        # The last header row becomes the column names, and the mapper keys
+        # take its place as the first row above the remaining header rows
+        header_rows = list(zip(*d.values()))
+        column_values: List[str] = list(header_rows[-1])
+        headers_df: pd.DataFrame = pd.DataFrame(
+            [list(d)] + header_rows[:-1], columns=column_values
+        )
 
         return headers_df
 
@@ -207,30 +428,23 @@ class SpreadsheetCreator:
 
         :return: The combined sample rows DataFrame.
         """
-        rows_df: pd.DataFrame = pd.DataFrame()
+        # Map each output column name to its metadata_df source column
+        columns: Dict[str, str] = {}
+        metadata_columns = frozenset(self.metadata_df.columns)
         for k, v in self.json_mapper.items():
-            if (
-                "sub_port_mapping" in v
-                and v["sub_port_mapping"] in self.metadata_df.columns.to_list()
-            ):
+            if "sub_port_mapping" in v and v["sub_port_mapping"] in metadata_columns:
                 if "header" in v:
-                    rows_df[v["header"]] = self.metadata_df[v["sub_port_mapping"]]
+                    columns[v["header"]] = v["sub_port_mapping"]
                 else:
-                    rows_df[k] = self.metadata_df[v["sub_port_mapping"]]
+                    columns[k] = v["sub_port_mapping"]
 
-        return rows_df
+        if not columns:
+            return pd.DataFrame()
 
-    def combine_headers_and_rows(
-        self, headers_df: pd.DataFrame, rows_df: pd.DataFrame
-    ) -> pd.DataFrame:
-        """
-        Combines the headers and sample rows DataFrames.
+        rows_df: pd.DataFrame = self.metadata_df.loc[:, list(columns.values())]
+        rows_df.columns = list(columns)
 
-        :param headers_df: The headers DataFrame.
-        :param rows_df: The sample rows DataFrame.
-        :return: The combined DataFrame.
-        """
-        return pd.concat([headers_df, rows_df])
+        return rows_df
 
     def create_spreadsheet(self, header: bool) -> pd.DataFrame:
         """
@@ -239,12 +453,74 @@ class SpreadsheetCreator:
         :param header: True if the headers should be included, False otherwise.
         :return: The created spreadsheet.
         """
-        headers_df = self.combine_headers_df(header)
-        rows_df = self.combine_sample_rows_df()
-        spreadsheet = self.combine_headers_and_rows(headers_df, rows_df)
+        # Headers only depend on json_mapper and rows only on metadata_df, so
+        # build both at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            headers_future = executor.submit(self.combine_headers_df, header)
+            rows_future = executor.submit(self.combine_sample_rows_df)
+            headers_df = headers_future.result()
+            rows_df = rows_future.result()
+
+        # Align both frames to the same columns up front so concat does not
+        # have to union and reindex them itself
+        extra_columns = rows_df.columns.difference(headers_df.columns, sort=False)
+        columns = headers_df.columns.append(extra_columns)
+        if not extra_columns.empty:
+            headers_df = headers_df.reindex(columns=columns, copy=False)
+        rows_df = rows_df.reindex(columns=columns, copy=False)
+
+        spreadsheet = pd.concat(
+            [headers_df, rows_df], axis=0, ignore_index=True, copy=False
+        )
         return spreadsheet
 
 
+def _excel_value(value: Any) -> Any:
+    """
+    Converts a value so openpyxl writes it the same way DataFrame.to_excel does.
+
+    :param value: The value to convert.
+    :return: The value to write to the cell.
+    """
+    if value is None or isinstance(value, EXCEL_CELL_TYPES):
+        return value
+    # np.bool_ is not a Number, and openpyxl would write it as 1/0
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return str(value)
+
+
+def write_spreadsheet(spreadsheet: pd.DataFrame, output: str) -> None:
+    """
+    Writes the spreadsheet to an XLSX file, streaming rows to disk with a
+    write-only openpyxl workbook rather than building every cell in memory.
+
+    :param spreadsheet: The spreadsheet to write.
+    :param output: Path to the output XLSX file.
+    """
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Sheet1")
+
+    # Match the header formatting of DataFrame.to_excel
+    thin = Side(style="thin")
+    header_cells: List[WriteOnlyCell] = []
+    for column in spreadsheet.columns:
+        cell = WriteOnlyCell(worksheet, value=column)
+        cell.font = Font(bold=True)
+        cell.border = Border(top=thin, right=thin, bottom=thin, left=thin)
+        cell.alignment = Alignment(horizontal="center", vertical="top")
+        header_cells.append(cell)
+    worksheet.append(header_cells)
+
+    # Like DataFrame.to_excel, write values Excel has no cell type for (such as
+    # list-valued fields) as their string representation
+    values = spreadsheet.astype(object).where(spreadsheet.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        worksheet.append([_excel_value(v) for v in row])
+
+    workbook.save(output)
+
+
 @click.command()
 @click.option("--submission", "-s", required=True, help="Metadata submission id.")
 @click.option(
@@ -270,6 +546,12 @@ class SpreadsheetCreator:
     required=True,
     help="Path to result output XLSX file.",
 )
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    show_default=True,
+    help="Reuse a submission record fetched in the last 10 minutes.",
+)
 def cli(
     submission: str,
     user_facility: str,
@@ -277,6 +559,7 @@ def cli(
     mapper: str,
     unique_field: str,
     output: str,
+    cache: bool,
 ) -> None:
     """
     Command-line interface for creating a spreadsheet based on metadata records.
@@ -287,14 +570,9 @@ def cli(
     :param mapper: Path to the JSON mapper specifying column mappings.
     :param unique_field: Unique field to identify the metadata records.
     :param output: Path to the output XLSX file.
+    :param cache: True to reuse a recently fetched submission record.
     """
-    load_dotenv()
-    env_path = os.path.join(os.path.dirname(__file__), ".env")
-    env_vars = dotenv_values(env_path)
-    for key, value in env_vars.items():
-        os.environ[key] = value
-
-    metadata_retriever = MetadataRetriever(submission, user_facility)
+    metadata_retriever = MetadataRetriever(submission, user_facility, cache)
     metadata_df = metadata_retriever.retrieve_metadata_records(unique_field)
 
     with open(mapper, "r") as f:
@@ -302,7 +580,7 @@ def cli(
 
     spreadsheet_creator = SpreadsheetCreator(json_mapper, metadata_df)
     user_facility_spreadsheet = spreadsheet_creator.create_spreadsheet(header)
-    user_facility_spreadsheet.to_excel(output, index=False)
+    write_spreadsheet(user_facility_spreadsheet, output)
 
 
 if __name__ == "__main__":